@@ -23,16 +23,37 @@ import os
 import re
 import shutil
 
+from collections import OrderedDict, deque, namedtuple
+
 import six
 
 from convert2rhel import exceptions, utils
 from convert2rhel.repo import get_hardcoded_repofiles_dir
 from convert2rhel.systeminfo import system_info
-from convert2rhel.utils import BACKUP_DIR, download_pkg, remove_orphan_folders, run_subprocess
+from convert2rhel.utils import BACKUP_DIR, download_pkg, download_pkgs_in_bulk, remove_orphan_folders, run_subprocess
 
 
 loggerinst = logging.getLogger(__name__)
 
+# Namedtuple with the repository settings used to download backups of packages.
+_BackupContext = namedtuple("_BackupContext", ("reposdir", "has_internet_access", "backup_dir_exists"))
+
+# rpm commands to install local packages with
+_RPM_INSTALL_CMD = ("rpm", "-i")
+_RPM_INSTALL_REPLACE_CMD = ("rpm", "-i", "--replacepkgs")
+# rpm options to skip verifying the digests and signatures of the installed packages
+_RPM_NO_VERIFY_OPTS = ("--nodigest", "--nosignature")
+
+# How much of the end of a failed command's output to put in an error diagnosis. The whole output is logged.
+_DIAGNOSIS_OUTPUT_LIMIT = 4096
+
+# Epoch at the start of a NEVRA string in the yum notation, e.g. "7:oraclelinux-release-7.9-1.0.9.el7.x86_64"
+_YUM_EPOCH_RE = re.compile(r"^\d+:")
+
+# A line printed by `rpm -q` for each of the queried packages that is not installed
+_RPM_NOT_INSTALLED_RE = re.compile(r"^package (\S+) is not installed$", re.MULTILINE)
+
+
 # Note: Currently the only use case for this is package removals
 class ChangedRPMPackagesController:
     """Keep control of installed/removed RPM pkgs for backup/restore."""
@@ -47,7 +68,7 @@ class ChangedRPMPackagesController:
 
     def track_installed_pkgs(self, pkgs):
         """Track packages installed before the PONR to be able to remove them later (roll them back) if needed."""
-        self.installed_pkgs += pkgs
+        self.installed_pkgs.extend(pkgs)
 
     def backup_and_track_removed_pkg(
         self,
@@ -56,6 +77,7 @@ class ChangedRPMPackagesController:
         set_releasever=False,
         custom_releasever=None,
         varsdir=None,
+        backup_context=None,
     ):
         """Add a removed RPM pkg to the list of removed pkgs."""
         restorable_pkg = RestorablePackage(pkg)
@@ -64,9 +86,62 @@ class ChangedRPMPackagesController:
             set_releasever=set_releasever,
             custom_releasever=custom_releasever,
             varsdir=varsdir,
+            backup_context=backup_context,
         )
         self.removed_pkgs.append(restorable_pkg)
 
+    def backup_and_track_removed_pkgs(
+        self,
+        pkgs,
+        reposdir=None,
+        set_releasever=False,
+        custom_releasever=None,
+        varsdir=None,
+    ):
+        """Back up RPM pkgs and add them to the list of removed pkgs.
+
+        The pkgs are downloaded using a single yumdownloader call first. The pkgs that couldn't be downloaded that way
+        are downloaded one by one.
+        """
+        backup_context = _prepare_backup_context(reposdir)
+        if not backup_context.backup_dir_exists:
+            # Warn just once instead of for each of the pkgs. Track them anyway so that the missing backups are
+            # reported during the rollback.
+            loggerinst.warning("Can't access %s" % BACKUP_DIR)
+            self.removed_pkgs.extend(RestorablePackage(pkg) for pkg in pkgs)
+            return
+
+        # Report each of the pkgs the same way RestorablePackage.backup() does
+        backup_reposdir = None
+        for pkg in pkgs:
+            loggerinst.info("Backing up %s." % pkg)
+            backup_reposdir = _get_backup_reposdir(backup_context)
+
+        # Load the repository metadata just once for all the pkgs. Only the pkgs that fail to download this way are
+        # downloaded one by one.
+        downloaded_pkgs = download_pkgs_in_bulk(
+            pkgs,
+            dest=BACKUP_DIR,
+            reposdir=backup_reposdir,
+            set_releasever=set_releasever,
+            custom_releasever=custom_releasever,
+            varsdir=varsdir,
+        )
+        for pkg in pkgs:
+            restorable_pkg = RestorablePackage(pkg)
+            if pkg in downloaded_pkgs:
+                restorable_pkg.path = downloaded_pkgs[pkg]
+            else:
+                restorable_pkg.path = download_pkg(
+                    pkg,
+                    dest=BACKUP_DIR,
+                    set_releasever=set_releasever,
+                    reposdir=backup_reposdir,
+                    custom_releasever=custom_releasever,
+                    varsdir=varsdir,
+                )
+            self.removed_pkgs.append(restorable_pkg)
+
     def _remove_installed_pkgs(self):
         """For each package installed during conversion remove it."""
         loggerinst.task("Rollback: Remove installed packages")
@@ -75,29 +150,35 @@ class ChangedRPMPackagesController:
     def _install_removed_pkgs(self):
         """For each package removed during conversion install it."""
         loggerinst.task("Rollback: Install removed packages")
-        pkgs_to_install = []
         for restorable_pkg in self.removed_pkgs:
             if restorable_pkg.path is None:
                 loggerinst.warning("Couldn't find a backup for %s package." % restorable_pkg.name)
-                continue
-            pkgs_to_install.append(restorable_pkg.path)
 
-        self._install_local_rpms(pkgs_to_install, replace=True, critical=False)
+        pkgs_to_install = [pkg.path for pkg in self.removed_pkgs if pkg.path is not None]
+
+        # The backups have been downloaded into our own backup dir by this very process. There's no point in
+        # verifying them again.
+        self._install_local_rpms(pkgs_to_install, replace=True, critical=False, verify=False)
 
-    def _install_local_rpms(self, pkgs_to_install, replace=False, critical=True):
-        """Install packages locally available."""
+    def _install_local_rpms(self, pkgs_to_install, replace=False, critical=True, verify=True):
+        """Install packages locally available.
+
+        Pass verify=False to skip verifying the digests and signatures of packages that come from a trusted
+        location, e.g. the backups we have downloaded ourselves.
+        """
 
         if not pkgs_to_install:
             loggerinst.info("No package to install.")
             return False
 
-        cmd_param = ["rpm", "-i"]
-        if replace:
-            cmd_param.append("--replacepkgs")
+        cmd_param = list(_RPM_INSTALL_REPLACE_CMD if replace else _RPM_INSTALL_CMD)
+        if not verify:
+            cmd_param.extend(_RPM_NO_VERIFY_OPTS)
 
-        loggerinst.info("Installing packages:")
+        log_info = loggerinst.info
+        log_info("Installing packages:")
         for pkg in pkgs_to_install:
-            loggerinst.info("\t%s" % pkg)
+            log_info("\t%s", pkg)
 
         cmd = cmd_param + pkgs_to_install
         output, ret_code = run_subprocess(cmd, print_output=False)
@@ -105,21 +186,25 @@ class ChangedRPMPackagesController:
             pkgs_as_str = utils.format_sequence_as_message(pkgs_to_install)
             loggerinst.debug(output.strip())
             if critical:
-                loggerinst.critical_no_exit("Error: Couldn't install %s packages." % pkgs_as_str)
+                message = "Couldn't install %s packages." % pkgs_as_str
+                loggerinst.critical_no_exit("Error: %s" % message)
                 raise exceptions.CriticalError(
                     id_="FAILED_TO_INSTALL_PACKAGES",
                     title="Couldn't install packages.",
                     description="While attempting to roll back changes, we encountered an unexpected failure while attempting to reinstall one or more packages that we removed as part of the conversion.",
-                    diagnosis="Couldn't install %s packages. Command: %s Output: %s Status: %d"
-                    % (pkgs_as_str, cmd, output, ret_code),
+                    diagnosis="%s Command: %s Output: %s Status: %d"
+                    % (message, cmd, output[-_DIAGNOSIS_OUTPUT_LIMIT:], ret_code),
                 )
 
-            loggerinst.warning("Couldn't install %s packages." % pkgs_as_str)
+            loggerinst.warning("Couldn't install %s packages.", pkgs_as_str)
             return False
 
+        # The NVRA of a package is the name of its rpm file without the extension
+        installed_nvras = []
         for path in pkgs_to_install:
-            nvra, _ = os.path.splitext(os.path.basename(path))
-            self.track_installed_pkg(nvra)
+            filename = path.rsplit("/", 1)[-1]
+            installed_nvras.append(filename[:-4] if filename.endswith(".rpm") else filename)
+        self.track_installed_pkgs(installed_nvras)
 
         return True
 
@@ -152,7 +237,11 @@ class BackupController:
     partition = object()
 
     def __init__(self):
-        self._restorables = []
+        self._restorables = deque()
+        # Number of the RestorableChanges on the stack, not counting partitions
+        self._non_partition_count = 0
+        # Stack of the indexes of the partitions in self._restorables
+        self._partitions = []
 
     def push(self, restorable):
         """
@@ -164,6 +253,7 @@ class BackupController:
         # the registered changes.  Remove it when all of the rollback items have
         # been ported into the backup controller.
         if restorable is self.partition:
+            self._partitions.append(len(self._restorables))
             self._restorables.append(restorable)
             return
 
@@ -173,6 +263,7 @@ class BackupController:
         restorable.enable()
 
         self._restorables.append(restorable)
+        self._non_partition_count += 1
 
     def pop(self):
         """
@@ -192,8 +283,10 @@ class BackupController:
 
         # Ignore the 1.4 partition hack
         if restorable is self.partition:
+            self._partitions.pop()
             return self.pop()
 
+        self._non_partition_count -= 1
         restorable.restore()
 
         return restorable
@@ -217,39 +310,65 @@ class BackupController:
         """
         # Only raise IndexError if there are no restorables registered.
         # Partitions are ignored for this check as they aren't really Changes.
-        if not self._restorables or all(r == self.partition for r in self._restorables):
+        if self._non_partition_count == 0:
             raise IndexError("No backups to restore")
 
+        if not self._partitions:
+            # Common case: without partitions on the stack there's nothing to skip or stop at.
+            processed_restorables = []
+            while self._restorables:
+                restorable = self._restorables.pop()
+                self._restore(restorable)
+                processed_restorables.append(restorable)
+
+            self._non_partition_count = 0
+            return processed_restorables
+
+        if _honor_partitions:
+            # Stop once the most recent partition is reached (this is how
+            # pop_to_partition() is implemented) and discard the partition.
+            self._restore_down_to(self._partitions.pop() + 1)
+            self._restorables.pop()
+            return []
+
+        processed_restorables = self._restore_down_to(0)
+        del self._partitions[:]
+
+        return processed_restorables
+
+    def _restore_down_to(self, size):
+        """
+        Restore the RestorableChanges on top of the stack until there are only `size` items left on it.
+
+        :returns: List of RestorableChange objects that were restored.
+        """
         # Restore the Changes in the reverse order the changes were enabled.
         processed_restorables = []
-        while True:
-            try:
-                restorable = self._restorables.pop()
-            except IndexError:
-                break
+        while len(self._restorables) > size:
+            restorable = self._restorables.pop()
 
             if restorable is self.partition:
-                if _honor_partitions:
-                    # Stop once a partition is reached (this is how
-                    # pop_to_partition() is implemented.
-                    return []
-                else:
-                    # This code ignores partitions.  Only pop_to_partition() honors
-                    # them.
-                    continue
-
-            try:
-                restorable.restore()
-            # Catch SystemExit too because we might still be calling
-            # logger.critical in some places.
-            except (Exception, SystemExit) as e:
-                # Don't let a failure in one restore influence the others
-                loggerinst.warning("Error while rolling back a %s: %s" % (restorable.__class__.__name__, str(e)))
+                # This code ignores partitions.  Only pop_to_partition() honors
+                # them.
+                continue
 
+            self._non_partition_count -= 1
+            self._restore(restorable)
             processed_restorables.append(restorable)
 
         return processed_restorables
 
+    @staticmethod
+    def _restore(restorable):
+        """Restore a RestorableChange, logging a failure instead of raising it."""
+        try:
+            restorable.restore()
+        # Catch SystemExit too because we might still be calling
+        # logger.critical in some places.
+        except (Exception, SystemExit) as e:
+            # Don't let a failure in one restore influence the others
+            loggerinst.warning("Error while rolling back a %s: %s" % (restorable.__class__.__name__, str(e)))
+
     def pop_to_partition(self):
         """
         This is part of a hack to get 1.4 out the door.  It should be removed once all rollback
@@ -270,8 +389,13 @@ class BackupController:
 class RestorableChange:
     """
     Interface definition for types which can be restored.
+
+    Many of these can be tracked during a conversion so the interface declares __slots__ to keep the instances
+    small. Subclasses need to declare their own __slots__ to benefit from that.
     """
 
+    __slots__ = ("enabled",)
+
     @abc.abstractmethod
     def __init__(self):
         self.enabled = False
@@ -295,6 +419,8 @@ class RestorableChange:
 class RestorableRpmKey(RestorableChange):
     """Import a GPG key into rpm in a reversible fashion."""
 
+    __slots__ = ("previously_installed", "keyfile", "keyid")
+
     def __init__(self, keyfile):
         """
         Setup a RestorableRpmKey to reflect the GPG key in a file.
@@ -409,6 +535,8 @@ class RestorableFile:
 # Over time we want to replace this with pkghandler.RestorablePackageSet
 # Right now, this is still used for removed packages.  Installed packages are handled by pkghandler.RestorablePackageSet
 class RestorablePackage:
+    __slots__ = ("name", "path")
+
     def __init__(self, pkgname):
         self.name = pkgname
         self.path = None
@@ -419,55 +547,79 @@ class RestorablePackage:
         set_releasever=False,
         custom_releasever=None,
         varsdir=None,
+        backup_context=None,
     ):
         """Save version of RPM package.
 
         :param reposdir: Custom repositories directory to be used in the backup.
         :type reposdir: str
+        :param backup_context: Repository settings returned by _prepare_backup_context(). Pass it when backing up
+            several packages so that the settings are resolved only once. Takes precedence over reposdir.
+        :type backup_context: _BackupContext
         """
         loggerinst.info("Backing up %s." % self.name)
-        if os.path.isdir(BACKUP_DIR):
-            # If we detect that the current system is an EUS release, then we
-            # proceed to use the hardcoded_repofiles, otherwise, we use the
-            # custom reposdir that comes from the method parameter. This is
-            # mainly because of CentOS Linux which we have hardcoded repofiles.
-            # If we ever put Oracle Linux repofiles to ship with convert2rhel,
-            # them the second part of this condition can be dropped.
-            if system_info.eus_system and system_info.id == "centos":
-                reposdir = get_hardcoded_repofiles_dir()
-
-            # One of the reasons we hardcode repofiles pointing to archived
-            # repositories of older system minor versions is that we need to be
-            # able to download an older package version as a backup. Because for
-            # example the default repofiles on CentOS Linux 8.4 point only to
-            # 8.latest repositories that already don't contain 8.4 packages.
-            if not system_info.has_internet_access:
-                if reposdir:
-                    loggerinst.debug(
-                        "Not using repository files stored in %s due to the absence of internet access." % reposdir
-                    )
-                self.path = download_pkg(
-                    self.name,
-                    dest=BACKUP_DIR,
-                    set_releasever=set_releasever,
-                    custom_releasever=custom_releasever,
-                    varsdir=varsdir,
-                )
-            else:
-                if reposdir:
-                    loggerinst.debug("Using repository files stored in %s." % reposdir)
-                self.path = download_pkg(
-                    self.name,
-                    dest=BACKUP_DIR,
-                    set_releasever=set_releasever,
-                    reposdir=reposdir,
-                    custom_releasever=custom_releasever,
-                    varsdir=varsdir,
-                )
+        if backup_context is None:
+            backup_context = _prepare_backup_context(reposdir)
+
+        if backup_context.backup_dir_exists:
+            self.path = download_pkg(
+                self.name,
+                dest=BACKUP_DIR,
+                set_releasever=set_releasever,
+                reposdir=_get_backup_reposdir(backup_context),
+                custom_releasever=custom_releasever,
+                varsdir=varsdir,
+            )
         else:
             loggerinst.warning("Can't access %s" % BACKUP_DIR)
 
 
+def _get_backup_reposdir(backup_context):
+    """Pick the repositories directory to download a backup of a package from.
+
+    :param backup_context: Repository settings returned by _prepare_backup_context().
+    :type backup_context: _BackupContext
+    :return: The repositories directory to use or None to use the system repositories.
+    :rtype: str | None
+    """
+    reposdir = backup_context.reposdir
+
+    # One of the reasons we hardcode repofiles pointing to archived
+    # repositories of older system minor versions is that we need to be
+    # able to download an older package version as a backup. Because for
+    # example the default repofiles on CentOS Linux 8.4 point only to
+    # 8.latest repositories that already don't contain 8.4 packages.
+    if not backup_context.has_internet_access:
+        if reposdir:
+            loggerinst.debug("Not using repository files stored in %s due to the absence of internet access.", reposdir)
+        return None
+
+    if reposdir:
+        loggerinst.debug("Using repository files stored in %s.", reposdir)
+    return reposdir
+
+
+def _prepare_backup_context(reposdir=None):
+    """Resolve the repository settings used to download backups of packages.
+
+    :param reposdir: Custom repositories directory to be used in the backup.
+    :type reposdir: str
+    :return: The repositories directory to use, whether the system has internet access and whether the backup
+        directory exists.
+    :rtype: _BackupContext
+    """
+    # If we detect that the current system is an EUS release, then we
+    # proceed to use the hardcoded_repofiles, otherwise, we use the
+    # custom reposdir that comes from the method parameter. This is
+    # mainly because of CentOS Linux which we have hardcoded repofiles.
+    # If we ever put Oracle Linux repofiles to ship with convert2rhel,
+    # them the second part of this condition can be dropped.
+    if system_info.eus_system and system_info.id == "centos":
+        reposdir = get_hardcoded_repofiles_dir()
+
+    return _BackupContext(reposdir, system_info.has_internet_access, os.path.isdir(BACKUP_DIR))
+
+
 def remove_pkgs(
     pkgs_to_remove,
     backup=True,
@@ -491,49 +643,99 @@ def remove_pkgs(
         loggerinst.info("No package to remove")
         return
 
+    # The same package can be requested more than once. Backing it up and removing it again would only make the
+    # second removal fail.
+    pkgs_to_remove = list(OrderedDict.fromkeys(pkgs_to_remove))
+
     if backup:
         # Some packages, when removed, will also remove repo files, making it
         # impossible to access the repositories to download a backup. For this
         # reason we first back up *all* packages and only after that we remove them.
-        for nevra in pkgs_to_remove:
-            changed_pkgs_control.backup_and_track_removed_pkg(
-                pkg=nevra,
-                reposdir=reposdir,
-                set_releasever=set_releasever,
-                custom_releasever=custom_releasever,
-                varsdir=varsdir,
-            )
+        changed_pkgs_control.backup_and_track_removed_pkgs(
+            pkgs_to_remove,
+            reposdir=reposdir,
+            set_releasever=set_releasever,
+            custom_releasever=custom_releasever,
+            varsdir=varsdir,
+        )
 
-    pkgs_failed_to_remove = []
+    # It's necessary to remove an epoch from the NEVRA string returned by yum because the rpm command does not
+    # handle the epoch well and considers the package we want to remove as not installed. On the other hand, the
+    # epoch in NEVRA returned by dnf is handled by rpm just fine.
+    pkgs = [(nevra, remove_epoch_from_yum_nevra_notation(nevra)) for nevra in pkgs_to_remove]
+    log_info = loggerinst.info
+    for _, nvra in pkgs:
+        log_info("Removing package: %s", nvra)
+
+    # rpm refuses to start the transaction when any of the packages is not installed, so leave those out.
+    pkgs_left, pkgs_not_installed = _split_pkgs_by_installed(pkgs)
+    pkgs_failed_to_remove = [nevra for nevra, _ in pkgs_not_installed]
     pkgs_removed = []
-    for nevra in pkgs_to_remove:
-        # It's necessary to remove an epoch from the NEVRA string returned by yum because the rpm command does not
-        # handle the epoch well and considers the package we want to remove as not installed. On the other hand, the
-        # epoch in NEVRA returned by dnf is handled by rpm just fine.
-        nvra = remove_epoch_from_yum_nevra_notation(nevra)
-        loggerinst.info("Removing package: %s" % nvra)
-        _, ret_code = run_subprocess(["rpm", "-e", "--nodeps", nvra])
-        if ret_code != 0:
-            pkgs_failed_to_remove.append(nevra)
+
+    if pkgs_left:
+        # Remove all the packages in a single rpm transaction
+        _, ret_code = run_subprocess(["rpm", "-e", "--nodeps"] + [nvra for _, nvra in pkgs_left])
+        if ret_code == 0:
+            pkgs_removed.extend(nevra for nevra, _ in pkgs_left)
         else:
-            pkgs_removed.append(nevra)
+            # Erasing a package may fail (e.g. on a failing scriptlet) without affecting the rest of the
+            # transaction. Whatever is no longer in the rpmdb has been removed.
+            pkgs_left, pkgs_gone = _split_pkgs_by_installed(pkgs_left)
+            pkgs_removed.extend(nevra for nevra, _ in pkgs_gone)
+
+            # As a last resort, remove the packages one by one to find out which of them is the culprit
+            for nevra, nvra in pkgs_left:
+                _, ret_code = run_subprocess(["rpm", "-e", "--nodeps", nvra])
+                if ret_code != 0:
+                    pkgs_failed_to_remove.append(nevra)
+                else:
+                    pkgs_removed.append(nevra)
 
     if pkgs_failed_to_remove:
         pkgs_as_str = utils.format_sequence_as_message(pkgs_failed_to_remove)
         if critical:
-            loggerinst.critical_no_exit("Error: Couldn't remove %s." % pkgs_as_str)
+            message = "Couldn't remove %s." % pkgs_as_str
+            loggerinst.critical_no_exit("Error: %s" % message)
             raise exceptions.CriticalError(
                 id_="FAILED_TO_REMOVE_PACKAGES",
                 title="Couldn't remove packages.",
                 description="While attempting to roll back changes, we encountered an unexpected failure while attempting to remove one or more of the packages we installed earlier.",
-                diagnosis="Couldn't remove %s." % pkgs_as_str,
+                diagnosis=message,
             )
         else:
-            loggerinst.warning("Couldn't remove %s." % pkgs_as_str)
+            loggerinst.warning("Couldn't remove %s.", pkgs_as_str)
 
     return pkgs_removed
 
 
+def _split_pkgs_by_installed(pkgs):
+    """Split packages into those that are installed and those that are not.
+
+    The packages are looked up using a single `rpm -q` call. The rpm Python bindings are not used on purpose as they
+    override the SIGINT handler of the main process on RHEL 7 (see utils.run_as_child_process()).
+
+    :param pkgs: Pairs of the package NEVRA and the NVRA to look up.
+    :type pkgs: list[tuple[str, str]]
+    :return: The installed and not installed pairs.
+    :rtype: tuple[list[tuple[str, str]], list[tuple[str, str]]]
+    """
+    if not pkgs:
+        return [], []
+
+    output, _ = run_subprocess(["rpm", "-q"] + [nvra for _, nvra in pkgs], print_cmd=False, print_output=False)
+    not_installed_nvras = set(_RPM_NOT_INSTALLED_RE.findall(output))
+
+    installed = []
+    not_installed = []
+    for pkg in pkgs:
+        if pkg[1] in not_installed_nvras:
+            not_installed.append(pkg)
+        else:
+            installed.append(pkg)
+
+    return installed, not_installed
+
+
 def remove_epoch_from_yum_nevra_notation(package_nevra):
     """Remove epoch from the NEVRA string returned by yum.
 
@@ -544,11 +746,7 @@ def remove_epoch_from_yum_nevra_notation(package_nevra):
     This function removes the epoch from the yum notation only.
     It's safe to pass the dnf notation string with an epoch. This function will return it as is.
     """
-    epoch_match = re.search(r"^\d+:(.*)", package_nevra)
-    if epoch_match:
-        # Return NVRA without the found epoch
-        return epoch_match.group(1)
-    return package_nevra
+    return _YUM_EPOCH_RE.sub("", package_nevra, count=1)
 
 
 changed_pkgs_control = ChangedRPMPackagesController()  # pylint: disable=C0103
@@ -38,33 +38,118 @@ def run_subprocess_with_empty_rpmdb(monkeypatch, tmpdir):
     return instrumented_run_subprocess
 
 
+@pytest.fixture
+def installed_pkgs(monkeypatch):
+    """Fake the lookup of installed packages that remove_pkgs() does.
+
+    Add package NVRAs to the returned set to make them look installed.
+    """
+    pkgs = set()
+
+    def split_pkgs_by_installed(pkgs_to_split):
+        installed = [pkg for pkg in pkgs_to_split if pkg[1] in pkgs]
+        not_installed = [pkg for pkg in pkgs_to_split if pkg[1] not in pkgs]
+        return installed, not_installed
+
+    monkeypatch.setattr(backup, "_split_pkgs_by_installed", split_pkgs_by_installed)
+
+    return pkgs
+
+
 class TestRemovePkgs:
-    def test_remove_pkgs_without_backup(self, monkeypatch):
+    def test_remove_pkgs_without_backup(self, installed_pkgs, monkeypatch):
         monkeypatch.setattr(backup.changed_pkgs_control, "backup_and_track_removed_pkg", mock.Mock())
         monkeypatch.setattr(backup, "run_subprocess", RunSubprocessMocked())
         pkgs = ["pkg1", "pkg2", "pkg3"]
+        installed_pkgs.update(pkgs)
 
         backup.remove_pkgs(pkgs, False)
 
         assert backup.changed_pkgs_control.backup_and_track_removed_pkg.call_count == 0
-        assert backup.run_subprocess.call_count == len(pkgs)
-
-        rpm_remove_cmd = ["rpm", "-e", "--nodeps"]
-        for cmd, pkg in zip(backup.run_subprocess.cmds, pkgs):
-            assert rpm_remove_cmd + [pkg] == cmd
+        assert backup.run_subprocess.call_count == 1
+        assert ["rpm", "-e", "--nodeps"] + pkgs == backup.run_subprocess.cmd
 
-    def test_remove_pkgs_with_backup(self, monkeypatch):
-        monkeypatch.setattr(backup.changed_pkgs_control, "backup_and_track_removed_pkg", mock.Mock())
+    def test_remove_pkgs_with_backup(self, installed_pkgs, monkeypatch, tmpdir):
+        monkeypatch.setattr(backup, "BACKUP_DIR", str(tmpdir))
+        monkeypatch.setattr(backup, "download_pkgs_in_bulk", mock.Mock(return_value={}))
+        monkeypatch.setattr(backup, "download_pkg", DownloadPkgMocked())
         monkeypatch.setattr(backup, "run_subprocess", RunSubprocessMocked())
         pkgs = ["pkg1", "pkg2", "pkg3"]
+        installed_pkgs.update(pkgs)
 
         backup.remove_pkgs(pkgs)
 
-        assert backup.changed_pkgs_control.backup_and_track_removed_pkg.call_count == len(pkgs)
-        assert backup.run_subprocess.call_count == len(pkgs)
-        rpm_remove_cmd = ["rpm", "-e", "--nodeps"]
-        for cmd, pkg in zip(backup.run_subprocess.cmds, pkgs):
-            assert rpm_remove_cmd + [pkg] == cmd
+        assert backup.download_pkg.call_count == len(pkgs)
+        assert backup.run_subprocess.call_count == 1
+        assert ["rpm", "-e", "--nodeps"] + pkgs == backup.run_subprocess.cmd
+
+    def test_remove_pkgs_with_epoch(self, installed_pkgs, monkeypatch):
+        monkeypatch.setattr(backup, "run_subprocess", RunSubprocessMocked())
+        installed_pkgs.update(["pkg1-1.0-1.el7.x86_64", "pkg2-1:1.0-1.el8.x86_64"])
+
+        pkgs = ["7:pkg1-1.0-1.el7.x86_64", "pkg2-1:1.0-1.el8.x86_64"]
+
+        pkgs_removed = backup.remove_pkgs(pkgs, backup=False)
+
+        assert pkgs_removed == pkgs
+        assert [
+            "rpm",
+            "-e",
+            "--nodeps",
+            "pkg1-1.0-1.el7.x86_64",
+            "pkg2-1:1.0-1.el8.x86_64",
+        ] == backup.run_subprocess.cmd
+
+    def test_remove_pkgs_duplicates(self, installed_pkgs, monkeypatch):
+        monkeypatch.setattr(backup.changed_pkgs_control, "backup_and_track_removed_pkgs", mock.Mock())
+        monkeypatch.setattr(backup, "run_subprocess", RunSubprocessMocked())
+        installed_pkgs.update(["pkg1", "pkg2"])
+
+        pkgs_removed = backup.remove_pkgs(["pkg2", "pkg1", "pkg2"])
+
+        backup.changed_pkgs_control.backup_and_track_removed_pkgs.assert_called_once_with(
+            ["pkg2", "pkg1"], reposdir=None, set_releasever=False, custom_releasever=None, varsdir=None
+        )
+        assert pkgs_removed == ["pkg2", "pkg1"]
+        assert backup.run_subprocess.cmds == [["rpm", "-e", "--nodeps", "pkg2", "pkg1"]]
+
+    def test_remove_pkgs_not_installed(self, installed_pkgs, monkeypatch, caplog):
+        monkeypatch.setattr(backup, "run_subprocess", RunSubprocessMocked())
+        installed_pkgs.update(["pkg1", "pkg3"])
+
+        pkgs_removed = backup.remove_pkgs(["pkg1", "pkg2", "pkg3"], backup=False, critical=False)
+
+        assert pkgs_removed == ["pkg1", "pkg3"]
+        assert backup.run_subprocess.cmds == [["rpm", "-e", "--nodeps", "pkg1", "pkg3"]]
+        assert "Couldn't remove pkg2." in caplog.records[-1].message
+
+    def test_remove_pkgs_none_installed(self, installed_pkgs, monkeypatch, caplog):
+        monkeypatch.setattr(backup, "run_subprocess", RunSubprocessMocked())
+
+        pkgs_removed = backup.remove_pkgs(["pkg1", "pkg2"], backup=False, critical=False)
+
+        assert pkgs_removed == []
+        assert backup.run_subprocess.call_count == 0
+        assert "Couldn't remove pkg1 and pkg2." in caplog.records[-1].message
+
+    def test_remove_pkgs_fallback_to_one_by_one(self, installed_pkgs, monkeypatch, caplog):
+        installed_pkgs.update(["pkg1", "pkg2", "pkg3"])
+
+        def remove_all_but_pkg2(cmd, *args, **kwargs):
+            # Emulate a failing scriptlet of pkg2, the rest of the transaction goes through
+            installed_pkgs.difference_update(set(cmd[3:]) - {"pkg2"})
+            return ("error: %preun(pkg2) scriptlet failed", 1) if "pkg2" in cmd else ("", 0)
+
+        monkeypatch.setattr(backup, "run_subprocess", RunSubprocessMocked(side_effect=remove_all_but_pkg2))
+
+        pkgs_removed = backup.remove_pkgs(["pkg1", "pkg2", "pkg3"], backup=False, critical=False)
+
+        assert pkgs_removed == ["pkg1", "pkg3"]
+        assert backup.run_subprocess.cmds == [
+            ["rpm", "-e", "--nodeps", "pkg1", "pkg2", "pkg3"],
+            ["rpm", "-e", "--nodeps", "pkg2"],
+        ]
+        assert "Couldn't remove pkg2." in caplog.records[-1].message
 
     @pytest.mark.parametrize(
         ("pkgs_to_remove", "ret_code", "backup_pkg", "critical", "expected"),
@@ -80,9 +165,11 @@ class TestRemovePkgs:
         backup_pkg,
         critical,
         expected,
+        installed_pkgs,
         monkeypatch,
         caplog,
     ):
+        installed_pkgs.update(pkgs_to_remove)
         run_subprocess_mock = RunSubprocessMocked(
             side_effect=unit_tests.run_subprocess_side_effect(
                 (("rpm", "-e", "--nodeps", pkgs_to_remove[0]), ("test", ret_code)),
@@ -110,6 +197,36 @@ class TestRemovePkgs:
         backup.remove_pkgs([])
         assert "No package to remove" in caplog.messages[-1]
 
+    def test_split_pkgs_by_installed(self, monkeypatch):
+        run_subprocess_mock = RunSubprocessMocked(
+            return_value=(
+                "pkg1-1.0-1.el8.x86_64\n"
+                "package pkg2-1:2.0-1.el8.x86_64 is not installed\n"
+                "pkg3-3.0-1.el8.noarch\n"
+                "package pkg4-4.0-1.el8.noarch is not installed\n",
+                2,
+            )
+        )
+        monkeypatch.setattr(backup, "run_subprocess", run_subprocess_mock)
+        pkgs = [
+            ("pkg1-1.0-1.el8.x86_64", "pkg1-1.0-1.el8.x86_64"),
+            ("pkg2-1:2.0-1.el8.x86_64", "pkg2-1:2.0-1.el8.x86_64"),
+            ("3:pkg3-3.0-1.el8.noarch", "pkg3-3.0-1.el8.noarch"),
+            ("pkg4-4.0-1.el8.noarch", "pkg4-4.0-1.el8.noarch"),
+        ]
+
+        installed, not_installed = backup._split_pkgs_by_installed(pkgs)
+
+        assert run_subprocess_mock.cmds == [["rpm", "-q"] + [nvra for _, nvra in pkgs]]
+        assert installed == [pkgs[0], pkgs[2]]
+        assert not_installed == [pkgs[1], pkgs[3]]
+
+    def test_split_pkgs_by_installed_with_empty_list(self, monkeypatch):
+        monkeypatch.setattr(backup, "run_subprocess", RunSubprocessMocked())
+
+        assert backup._split_pkgs_by_installed([]) == ([], [])
+        assert backup.run_subprocess.call_count == 0
+
 
 class TestChangedPkgsControlInstallLocalRPMS:
     def test_install_local_rpms_with_empty_list(self, monkeypatch):
@@ -120,27 +237,53 @@ class TestChangedPkgsControlInstallLocalRPMS:
         assert backup.run_subprocess.call_count == 0
 
     def test_install_local_rpms_without_replace(self, monkeypatch):
-        monkeypatch.setattr(backup.changed_pkgs_control, "track_installed_pkg", mock.Mock())
+        monkeypatch.setattr(backup.changed_pkgs_control, "track_installed_pkgs", mock.Mock())
         monkeypatch.setattr(backup, "run_subprocess", RunSubprocessMocked())
         pkgs = ["pkg1", "pkg2", "pkg3"]
 
         backup.changed_pkgs_control._install_local_rpms(pkgs)
 
-        assert backup.changed_pkgs_control.track_installed_pkg.call_count == len(pkgs)
+        backup.changed_pkgs_control.track_installed_pkgs.assert_called_once_with(pkgs)
         assert backup.run_subprocess.call_count == 1
         assert ["rpm", "-i", "pkg1", "pkg2", "pkg3"] == backup.run_subprocess.cmd
 
     def test_install_local_rpms_with_replace(self, monkeypatch):
-        monkeypatch.setattr(backup.changed_pkgs_control, "track_installed_pkg", mock.Mock())
+        monkeypatch.setattr(backup.changed_pkgs_control, "track_installed_pkgs", mock.Mock())
         monkeypatch.setattr(backup, "run_subprocess", RunSubprocessMocked())
         pkgs = ["pkg1", "pkg2", "pkg3"]
 
         backup.changed_pkgs_control._install_local_rpms(pkgs, replace=True)
 
-        assert backup.changed_pkgs_control.track_installed_pkg.call_count == len(pkgs)
+        backup.changed_pkgs_control.track_installed_pkgs.assert_called_once_with(pkgs)
         assert backup.run_subprocess.call_count == 1
         assert ["rpm", "-i", "--replacepkgs", "pkg1", "pkg2", "pkg3"] == backup.run_subprocess.cmd
 
+    def test_install_local_rpms_tracks_nvras(self, monkeypatch):
+        monkeypatch.setattr(backup, "run_subprocess", RunSubprocessMocked())
+        pkgs = ["/backup/pkg1-1.0-1.el8.x86_64.rpm", "pkg2-2.0-1.el8.noarch.rpm"]
+
+        control = backup.ChangedRPMPackagesController()
+        control._install_local_rpms(pkgs)
+
+        assert control.installed_pkgs == ["pkg1-1.0-1.el8.x86_64", "pkg2-2.0-1.el8.noarch"]
+
+    def test_install_local_rpms_without_verify(self, monkeypatch):
+        monkeypatch.setattr(backup, "run_subprocess", RunSubprocessMocked())
+        pkgs = ["pkg1", "pkg2"]
+
+        control = backup.ChangedRPMPackagesController()
+        control._install_local_rpms(pkgs, replace=True, verify=False)
+
+        assert [
+            "rpm",
+            "-i",
+            "--replacepkgs",
+            "--nodigest",
+            "--nosignature",
+            "pkg1",
+            "pkg2",
+        ] == backup.run_subprocess.cmd
+
 
 def test_backup_and_track_removed_pkg(monkeypatch):
     monkeypatch.setattr(backup.RestorablePackage, "backup", mock.Mock())
@@ -154,6 +297,139 @@ def test_backup_and_track_removed_pkg(monkeypatch):
     assert len(control.removed_pkgs) == len(pkgs)
 
 
+def test_backup_and_track_removed_pkgs(monkeypatch, tmpdir):
+    monkeypatch.setattr(backup, "BACKUP_DIR", str(tmpdir))
+    monkeypatch.setattr(backup, "download_pkgs_in_bulk", mock.Mock(return_value={}))
+    monkeypatch.setattr(backup, "download_pkg", DownloadPkgMocked(return_value="/backup/pkg.rpm"))
+
+    control = backup.ChangedRPMPackagesController()
+    pkgs = ["pkg1", "pkg2", "pkg3"]
+    control.backup_and_track_removed_pkgs(pkgs)
+
+    assert backup.download_pkg.call_count == len(pkgs)
+    assert [(pkg.name, pkg.path) for pkg in control.removed_pkgs] == [(pkg, "/backup/pkg.rpm") for pkg in pkgs]
+
+
+def test_backup_and_track_removed_pkgs_prepares_backup_context_once(monkeypatch):
+    backup_context = backup._BackupContext(reposdir="/some/reposdir", has_internet_access=True, backup_dir_exists=True)
+    prepare_backup_context_mock = mock.Mock(return_value=backup_context)
+    monkeypatch.setattr(backup, "_prepare_backup_context", prepare_backup_context_mock)
+    monkeypatch.setattr(backup, "download_pkgs_in_bulk", mock.Mock(return_value={}))
+    monkeypatch.setattr(backup, "download_pkg", DownloadPkgMocked())
+
+    control = backup.ChangedRPMPackagesController()
+    control.backup_and_track_removed_pkgs(["pkg1", "pkg2", "pkg3"], reposdir="/some/reposdir")
+
+    prepare_backup_context_mock.assert_called_once_with("/some/reposdir")
+    assert backup.download_pkg.call_count == 3
+    for call in backup.download_pkg.call_args_list:
+        assert call[1]["reposdir"] == "/some/reposdir"
+
+
+def test_backup_and_track_removed_pkgs_downloaded_in_bulk(monkeypatch, tmpdir):
+    monkeypatch.setattr(backup, "BACKUP_DIR", str(tmpdir))
+    backup_context = backup._BackupContext(reposdir="/some/reposdir", has_internet_access=True, backup_dir_exists=True)
+    monkeypatch.setattr(backup, "_prepare_backup_context", mock.Mock(return_value=backup_context))
+    download_pkgs_in_bulk_mock = mock.Mock(return_value={"pkg1": "/backup/pkg1.rpm", "pkg3": "/backup/pkg3.rpm"})
+    monkeypatch.setattr(backup, "download_pkgs_in_bulk", download_pkgs_in_bulk_mock)
+    monkeypatch.setattr(backup, "download_pkg", DownloadPkgMocked(return_value="/backup/pkg2.rpm"))
+
+    control = backup.ChangedRPMPackagesController()
+    control.backup_and_track_removed_pkgs(["pkg1", "pkg2", "pkg3"], set_releasever=True, custom_releasever="7")
+
+    download_pkgs_in_bulk_mock.assert_called_once_with(
+        ["pkg1", "pkg2", "pkg3"],
+        dest=str(tmpdir),
+        reposdir="/some/reposdir",
+        set_releasever=True,
+        custom_releasever="7",
+        varsdir=None,
+    )
+    # Only the pkg missed by the bulk download is backed up on its own
+    assert backup.download_pkg.call_count == 1
+    assert backup.download_pkg.pkg == "pkg2"
+    assert [(pkg.name, pkg.path) for pkg in control.removed_pkgs] == [
+        ("pkg1", "/backup/pkg1.rpm"),
+        ("pkg2", "/backup/pkg2.rpm"),
+        ("pkg3", "/backup/pkg3.rpm"),
+    ]
+
+
+@pytest.mark.parametrize(
+    ("has_internet_access", "expected_reposdir", "expected_message"),
+    (
+        (True, "/some/reposdir", "Using repository files stored in /some/reposdir."),
+        (
+            False,
+            None,
+            "Not using repository files stored in /some/reposdir due to the absence of internet access.",
+        ),
+    ),
+)
+def test_backup_and_track_removed_pkgs_logging(
+    has_internet_access, expected_reposdir, expected_message, monkeypatch, tmpdir, caplog
+):
+    monkeypatch.setattr(backup, "BACKUP_DIR", str(tmpdir))
+    backup_context = backup._BackupContext(
+        reposdir="/some/reposdir", has_internet_access=has_internet_access, backup_dir_exists=True
+    )
+    monkeypatch.setattr(backup, "_prepare_backup_context", mock.Mock(return_value=backup_context))
+
+    def download_pkgs_in_bulk_mock(pkgs, **kwargs):
+        backup.loggerinst.info("Successfully downloaded the pkg1 package.")
+        return {"pkg1": "/backup/pkg1.rpm"}
+
+    monkeypatch.setattr(backup, "download_pkgs_in_bulk", mock.Mock(side_effect=download_pkgs_in_bulk_mock))
+    monkeypatch.setattr(backup, "download_pkg", DownloadPkgMocked(return_value="/backup/pkg2.rpm"))
+
+    control = backup.ChangedRPMPackagesController()
+    control.backup_and_track_removed_pkgs(["pkg1", "pkg2"])
+
+    # The pkgs are reported the same way as when backed up one by one, before any of them is downloaded
+    assert caplog.messages == [
+        "Backing up pkg1.",
+        expected_message,
+        "Backing up pkg2.",
+        expected_message,
+        "Successfully downloaded the pkg1 package.",
+    ]
+    assert backup.download_pkgs_in_bulk.call_args[1]["reposdir"] == expected_reposdir
+    assert backup.download_pkg.call_args[1]["reposdir"] == expected_reposdir
+
+
+def test_backup_and_track_removed_pkgs_without_dir(monkeypatch, tmpdir, caplog):
+    backup_dir = str(tmpdir.join("non-existing"))
+    monkeypatch.setattr(backup, "BACKUP_DIR", backup_dir)
+    monkeypatch.setattr(backup, "download_pkg", DownloadPkgMocked())
+
+    control = backup.ChangedRPMPackagesController()
+    control.backup_and_track_removed_pkgs(["pkg1", "pkg2"])
+
+    assert backup.download_pkg.call_count == 0
+    assert [pkg.name for pkg in control.removed_pkgs] == ["pkg1", "pkg2"]
+    assert all(pkg.path is None for pkg in control.removed_pkgs)
+    assert caplog.messages.count("Can't access %s" % backup_dir) == 1
+
+
+def test_backup_and_track_removed_pkgs_failure(monkeypatch, tmpdir):
+    monkeypatch.setattr(backup, "BACKUP_DIR", str(tmpdir))
+    monkeypatch.setattr(backup, "download_pkgs_in_bulk", mock.Mock(return_value={}))
+
+    def download_pkg_mock(pkg, *args, **kwargs):
+        if pkg == "pkg2":
+            raise SystemExit("Couldn't download the pkg2 package.")
+        return "/backup/%s.rpm" % pkg
+
+    monkeypatch.setattr(backup, "download_pkg", download_pkg_mock)
+
+    control = backup.ChangedRPMPackagesController()
+    with pytest.raises(SystemExit, match="Couldn't download the pkg2 package."):
+        control.backup_and_track_removed_pkgs(["pkg1", "pkg2", "pkg3"])
+
+    # The backups stop at the first failure
+    assert [pkg.name for pkg in control.removed_pkgs] == ["pkg1"]
+
+
 def test_track_installed_pkg():
     control = backup.ChangedRPMPackagesController()
     pkgs = ["pkg1", "pkg2", "pkg3"]
@@ -169,8 +445,9 @@ def test_track_installed_pkgs():
     assert control.installed_pkgs == pkgs
 
 
-def test_changed_pkgs_control_remove_installed_pkgs(monkeypatch, caplog):
+def test_changed_pkgs_control_remove_installed_pkgs(installed_pkgs, monkeypatch, caplog):
     removed_pkgs = ["pkg_1"]
+    installed_pkgs.update(removed_pkgs)
     run_subprocess_mock = RunSubprocessMocked(
         side_effect=unit_tests.run_subprocess_side_effect(
             (("rpm", "-e", "--nodeps", removed_pkgs[0]), ("test", 0)),
@@ -198,7 +475,7 @@ def test_changed_pkgs_control_install_removed_pkgs(monkeypatch):
     )
     backup.changed_pkgs_control.removed_pkgs = removed_pkgs
     backup.changed_pkgs_control._install_removed_pkgs()
-    assert install_local_rpms_mock.call_count == 1
+    install_local_rpms_mock.assert_called_once_with([removed_pkgs[0].path], replace=True, critical=False, verify=False)
 
 
 def test_changed_pkgs_control_install_removed_pkgs_without_path(monkeypatch, caplog):
@@ -345,6 +622,18 @@ def test_changedrpms_packages_controller_install_local_rpms(monkeypatch, caplog)
     assert "Couldn't install %s packages." % pkgs[0] in caplog.records[-1].message
 
 
+def test_changedrpms_packages_controller_install_local_rpms_long_output(monkeypatch):
+    output = "start of the output" + "x" * backup._DIAGNOSIS_OUTPUT_LIMIT
+    monkeypatch.setattr(backup, "run_subprocess", RunSubprocessMocked(return_value=(output, 1)))
+
+    control = backup.ChangedRPMPackagesController()
+    with pytest.raises(exceptions.CriticalError) as err:
+        control._install_local_rpms(pkgs_to_install=["pkg-1"], replace=False, critical=True)
+
+    assert "start of the output" not in err.value.diagnosis
+    assert output[-backup._DIAGNOSIS_OUTPUT_LIMIT :] in err.value.diagnosis
+
+
 def test_changedrpms_packages_controller_install_local_rpms_system_exit(monkeypatch, caplog):
     pkgs = ["pkg-1"]
     run_subprocess_mock = RunSubprocessMocked(
@@ -388,6 +677,48 @@ def test_restorable_package_backup(pretend_os, is_eus_system, has_internet_acces
     assert download_pkg_mock.call_count == 1
 
 
+@pytest.mark.parametrize(
+    ("has_internet_access", "expected_reposdir", "expected_message"),
+    (
+        (True, "/context/reposdir", "Using repository files stored in /context/reposdir."),
+        (
+            False,
+            None,
+            "Not using repository files stored in /context/reposdir due to the absence of internet access.",
+        ),
+    ),
+)
+def test_restorable_package_backup_with_context(
+    has_internet_access, expected_reposdir, expected_message, tmpdir, monkeypatch, caplog
+):
+    download_pkg_mock = DownloadPkgMocked()
+    prepare_backup_context_mock = mock.Mock()
+    monkeypatch.setattr(backup, "download_pkg", value=download_pkg_mock)
+    monkeypatch.setattr(backup, "BACKUP_DIR", value=str(tmpdir))
+    monkeypatch.setattr(backup, "_prepare_backup_context", value=prepare_backup_context_mock)
+    backup_context = backup._BackupContext(
+        reposdir="/context/reposdir", has_internet_access=has_internet_access, backup_dir_exists=True
+    )
+
+    rp = backup.RestorablePackage(pkgname="pkg-1")
+    rp.backup(reposdir="/ignored/reposdir", backup_context=backup_context)
+
+    assert prepare_backup_context_mock.call_count == 0
+    assert download_pkg_mock.call_count == 1
+    assert download_pkg_mock.call_args[1].get("reposdir") == expected_reposdir
+    assert expected_message in caplog.messages
+
+
+@centos8
+def test_prepare_backup_context_eus(pretend_os, tmpdir, monkeypatch):
+    monkeypatch.setattr(backup.system_info, "eus_system", value=True)
+    monkeypatch.setattr(backup.system_info, "has_internet_access", value=True)
+    monkeypatch.setattr(backup, "get_hardcoded_repofiles_dir", value=lambda: str(tmpdir))
+    monkeypatch.setattr(backup, "BACKUP_DIR", value=str(tmpdir))
+
+    assert backup._prepare_backup_context("/some/reposdir") == (str(tmpdir), True, True)
+
+
 @pytest.fixture
 def backup_controller():
     return backup.BackupController()
@@ -502,7 +833,7 @@ class TestBackupController:
         restorable = backup_controller.pop()
 
         assert restorable == restorable1
-        assert backup_controller._restorables == []
+        assert list(backup_controller._restorables) == []
 
     def test_pop_all_with_partition(self, backup_controller):
         restorable1 = MinimalRestorable()
@@ -524,15 +855,68 @@ class TestBackupController:
         backup_controller.push(backup_controller.partition)
         backup_controller.push(restorable2)
 
-        assert backup_controller._restorables == [restorable1, backup_controller.partition, restorable2]
+        assert list(backup_controller._restorables) == [restorable1, backup_controller.partition, restorable2]
 
         backup_controller.pop_to_partition()
 
-        assert backup_controller._restorables == [restorable1]
+        assert list(backup_controller._restorables) == [restorable1]
 
         backup_controller.pop_to_partition()
 
-        assert backup_controller._restorables == []
+        assert list(backup_controller._restorables) == []
+
+    def test_pop_to_partition_multiple_partitions(self, backup_controller):
+        restorable1 = MinimalRestorable()
+        restorable2 = MinimalRestorable()
+        restorable3 = MinimalRestorable()
+
+        backup_controller.push(restorable1)
+        backup_controller.push(backup_controller.partition)
+        backup_controller.push(restorable2)
+        backup_controller.push(backup_controller.partition)
+        backup_controller.push(restorable3)
+
+        backup_controller.pop_to_partition()
+
+        assert restorable3.called["restore"] == 1
+        assert restorable2.called["restore"] == 0
+        assert list(backup_controller._restorables) == [restorable1, backup_controller.partition, restorable2]
+
+        backup_controller.pop_to_partition()
+
+        assert restorable2.called["restore"] == 1
+        assert restorable1.called["restore"] == 0
+        assert list(backup_controller._restorables) == [restorable1]
+
+    def test_pop_all_after_pop_to_partition(self, backup_controller):
+        restorable1 = MinimalRestorable()
+        restorable2 = MinimalRestorable()
+        restorable3 = MinimalRestorable()
+
+        backup_controller.push(restorable1)
+        backup_controller.push(backup_controller.partition)
+        backup_controller.push(restorable2)
+        backup_controller.pop_to_partition()
+        backup_controller.push(restorable3)
+
+        restorables = backup_controller.pop_all()
+
+        assert restorables == [restorable3, restorable1]
+        assert list(backup_controller._restorables) == []
+        with pytest.raises(IndexError, match="No backups to restore"):
+            backup_controller.pop_all()
+
+    def test_pop_all_with_only_partitions(self, backup_controller):
+        restorable1 = MinimalRestorable()
+
+        backup_controller.push(backup_controller.partition)
+        backup_controller.push(restorable1)
+        backup_controller.push(backup_controller.partition)
+
+        assert backup_controller.pop() == restorable1
+
+        with pytest.raises(IndexError, match="No backups to restore"):
+            backup_controller.pop_all()
 
     # End of tests that are for the 1.4 partition hack.
 
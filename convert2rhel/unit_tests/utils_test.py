@@ -552,6 +552,57 @@ class TestDownload_pkg:
 
         assert path is None
 
+    def test_download_pkgs_in_bulk(self, monkeypatch, tmpdir, caplog):
+        monkeypatch.setattr(system_info, "version", systeminfo.Version(8, 0))
+        output = (
+            "Last metadata expiration check: 0:00:01 ago.\n"
+            "(1/2): pkg1-1.0-1.el8.x86_64.rpm     2.2 MB/s | 1.4 MB     00:00\n"
+            "[SKIPPED] pkg2-2.0-1.el8.x86_64.rpm: Already downloaded\n"
+            "using local copy of 7:pkg3-3.0-1.el7.x86_64\n"
+        )
+        monkeypatch.setattr(utils, "run_cmd_in_pty", RunCmdInPtyMocked(return_string=output))
+        for rpm_name in ("pkg1-1.0-1.el8.x86_64.rpm", "pkg2-2.0-1.el8.x86_64.rpm", "pkg3-3.0-1.el7.x86_64.rpm"):
+            tmpdir.join(rpm_name).write("")
+        dest = str(tmpdir)
+        pkgs = ["pkg1-1.0-1.el8.x86_64", "pkg2-1:2.0-1.el8.x86_64", "7:pkg3-3.0-1.el7.x86_64", "pkg4"]
+
+        paths = utils.download_pkgs_in_bulk(pkgs, dest=dest, reposdir="/reposdir/", set_releasever=False)
+
+        assert utils.run_cmd_in_pty.call_count == 1
+        assert [
+            "yumdownloader",
+            "-v",
+            "--destdir=%s" % dest,
+            "--setopt=reposdir=/reposdir/",
+            "--setopt=module_platform_id=platform:el8",
+        ] + pkgs == utils.run_cmd_in_pty.cmd
+        assert paths == {
+            "pkg1-1.0-1.el8.x86_64": os.path.join(dest, "pkg1-1.0-1.el8.x86_64.rpm"),
+            "pkg2-1:2.0-1.el8.x86_64": os.path.join(dest, "pkg2-2.0-1.el8.x86_64.rpm"),
+            "7:pkg3-3.0-1.el7.x86_64": os.path.join(dest, "pkg3-3.0-1.el7.x86_64.rpm"),
+        }
+        assert "Successfully downloaded the pkg2-1:2.0-1.el8.x86_64 package." in caplog.messages
+        assert "Successfully downloaded the pkg4 package." not in caplog.messages
+
+    def test_download_pkgs_in_bulk_failed_download(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(system_info, "version", systeminfo.Version(7, 0))
+        output = "No Match for argument pkg2-1.0-1.el7.x86_64\npkg1-1.0-1.el7.x86_64.rpm   | 1.4 MB     00:00\n"
+        monkeypatch.setattr(utils, "run_cmd_in_pty", RunCmdInPtyMocked(return_string=output, return_code=1))
+        # Neither a leftover rpm nor an rpm reported as downloaded but missing in dest counts as downloaded
+        tmpdir.join("pkg2-1.0-1.el7.x86_64.rpm").write("")
+
+        paths = utils.download_pkgs_in_bulk(
+            ["pkg1-1.0-1.el7.x86_64", "pkg2-1.0-1.el7.x86_64"], dest=str(tmpdir), set_releasever=False
+        )
+
+        assert paths == {}
+
+    def test_download_pkgs_in_bulk_with_empty_list(self, monkeypatch):
+        monkeypatch.setattr(utils, "run_cmd_in_pty", RunCmdInPtyMocked())
+
+        assert utils.download_pkgs_in_bulk([]) == {}
+        assert utils.run_cmd_in_pty.call_count == 0
+
 
 @pytest.mark.parametrize(("output",), [[out] for out in YUMDOWNLOADER_OUTPUTS])
 def test_get_rpm_path_from_yumdownloader_output(output):
@@ -73,6 +73,9 @@ DATA_DIR = "/usr/share/convert2rhel/"
 TMP_DIR = "/var/lib/convert2rhel/"
 BACKUP_DIR = os.path.join(TMP_DIR, "backup")
 
+# Epoch in both the yum (E:N-V-R.A) and the dnf (N-E:V-R.A) notation of a NEVRA
+_NEVRA_EPOCH_RE = re.compile(r"(^|-)\d+:")
+
 
 class UnableToSerialize(Exception):
     """
@@ -665,34 +668,9 @@ def download_pkg(
 
     loggerinst.debug("Downloading the %s package." % pkg)
 
-    # On RHEL 7, it's necessary to invoke yumdownloader with -v, otherwise there's no output to stdout.
-    cmd = ["yumdownloader", "-v", "--destdir=%s" % dest]
-    if reposdir:
-        cmd.append("--setopt=reposdir=%s" % reposdir)
-
-    if isinstance(disable_repos, list):
-        for repo in disable_repos:
-            cmd.append("--disablerepo=%s" % repo)
-
-    if isinstance(enable_repos, list):
-        for repo in enable_repos:
-            cmd.append("--enablerepo=%s" % repo)
-
-    if set_releasever:
-        if not custom_releasever and not system_info.releasever:
-            raise AssertionError("custom_releasever or system_info.releasever must be set.")
-
-        if custom_releasever:
-            cmd.append("--releasever=%s" % custom_releasever)
-        else:
-            cmd.append("--releasever=%s" % system_info.releasever)
-
-    if varsdir:
-        cmd.append("--setopt=varsdir=%s" % varsdir)
-
-    if system_info.version.major >= 8:
-        cmd.append("--setopt=module_platform_id=platform:el" + str(system_info.version.major))
-
+    cmd = _get_yumdownloader_cmd(
+        dest, reposdir, enable_repos, disable_repos, set_releasever, custom_releasever, varsdir
+    )
     cmd.append(pkg)
 
     output, ret_code = run_cmd_in_pty(cmd, print_output=False)
@@ -761,6 +739,108 @@ def download_pkg(
     return path
 
 
+def download_pkgs_in_bulk(
+    pkgs,
+    dest=TMP_DIR,
+    reposdir=None,
+    set_releasever=True,
+    custom_releasever=None,
+    varsdir=None,
+):
+    """Download rpms using a single yumdownloader call and return the filepaths of those that got downloaded.
+
+    Unlike download_pkg(), the repository metadata is loaded only once for all the packages. A failure to download
+    any of the packages is not treated as an error. The packages missing in the returned mapping are expected to be
+    downloaded one by one through download_pkg() which takes care of reporting the failure.
+
+    :param pkgs: NEVRAs of the packages that will be downloaded. Both the yum (E:N-V-R.A) and the dnf (N-E:V-R.A)
+        notations are accepted. Any other package specification ends up among the packages that weren't downloaded.
+    :type pkgs: list[str]
+    :param dest: The destination to download the packages. Defaults to `TMP_DIR`
+    :type dest: str
+    :param reposdir: The folder with custom repositories to download.
+    :type reposdir: str
+    :param set_releasever: If it's necessary to use the releasever stored in SystemInfo.releasever.
+    :type set_releasever: bool
+    :param custom_releasever: A custom releasever to use. An alternative to set_releasever.
+    :type custom_releasever: int | str
+    :param varsdir: The path to the variables directory.
+    :type varsdir: str
+
+    :return: The filepaths of the downloaded packages keyed by the package NEVRAs.
+    :rtype: dict[str, str]
+    """
+    if not pkgs:
+        return {}
+
+    loggerinst.debug("Downloading the %s packages." % ", ".join(pkgs))
+
+    cmd = _get_yumdownloader_cmd(dest, reposdir, None, None, set_releasever, custom_releasever, varsdir)
+    cmd.extend(pkgs)
+
+    output, ret_code = run_cmd_in_pty(cmd, print_output=False)
+    if ret_code != 0:
+        loggerinst.debug("Output from the yumdownloader call:\n%s" % output)
+
+    downloaded_rpms = set()
+    for line in output.splitlines():
+        rpm_name_match = re.search(r"\S*\.rpm", line)
+        pkg_nevra_match = re.search(r"^using local copy of (?:\d+:)?(.*)$", line)
+        if rpm_name_match:
+            downloaded_rpms.add(os.path.basename(rpm_name_match.group(0)))
+        elif pkg_nevra_match:
+            downloaded_rpms.add(pkg_nevra_match.group(1) + ".rpm")
+
+    paths = {}
+    for pkg in pkgs:
+        rpm_name = _NEVRA_EPOCH_RE.sub(r"\1", pkg, count=1) + ".rpm"
+        path = os.path.join(dest, rpm_name)
+        if rpm_name in downloaded_rpms and os.path.isfile(path):
+            loggerinst.info("Successfully downloaded the %s package." % pkg)
+            loggerinst.debug("Path of the downloaded package: %s" % path)
+            paths[pkg] = path
+
+    return paths
+
+
+def _get_yumdownloader_cmd(dest, reposdir, enable_repos, disable_repos, set_releasever, custom_releasever, varsdir):
+    """Assemble the yumdownloader command, without the packages to download, for the given download settings.
+
+    See download_pkg() for the description of the parameters.
+    """
+    from convert2rhel.systeminfo import system_info
+
+    # On RHEL 7, it's necessary to invoke yumdownloader with -v, otherwise there's no output to stdout.
+    cmd = ["yumdownloader", "-v", "--destdir=%s" % dest]
+    if reposdir:
+        cmd.append("--setopt=reposdir=%s" % reposdir)
+
+    if isinstance(disable_repos, list):
+        for repo in disable_repos:
+            cmd.append("--disablerepo=%s" % repo)
+
+    if isinstance(enable_repos, list):
+        for repo in enable_repos:
+            cmd.append("--enablerepo=%s" % repo)
+
+    if set_releasever:
+        if not custom_releasever and not system_info.releasever:
+            raise AssertionError("custom_releasever or system_info.releasever must be set.")
+
+        if custom_releasever:
+            cmd.append("--releasever=%s" % custom_releasever)
+        else:
+            cmd.append("--releasever=%s" % system_info.releasever)
+
+    if varsdir:
+        cmd.append("--setopt=varsdir=%s" % varsdir)
+
+    if system_info.version.major >= 8:
+        cmd.append("--setopt=module_platform_id=platform:el" + str(system_info.version.major))
+
+    return cmd
+
+
 def get_rpm_path_from_yumdownloader_output(cmd, output, dest):
     """Parse the output of yumdownloader to get the filepath of the downloaded rpm.
 